@@ -1,7 +1,10 @@
+import inspect
 import json
 import os
-from openai import OpenAI
+import threading
+import time
 from dotenv import load_dotenv
+from llm_pool import EndpointPool
 from tools import (
     get_lasted_change_page_id,
     wrap_url,
@@ -10,6 +13,10 @@ from tools import (
     search_pages,
     get_page_properties,
     get_blocks,
+    get_page_text,
+    summarize_pages_cached,
+    get_database_schema,
+    query_database,
     clear_rich_text,
     append_text,
     append_page_mention,
@@ -19,11 +26,56 @@ from tools import (
 # 加载环境变量
 load_dotenv()
 
-# 初始化 OpenAI 客户端
-client = OpenAI(
-    api_key=os.getenv("LLM_API_KEY"),
-    base_url=os.getenv("LLM_BASE_URL").replace("/chat/completions", "")
-)
+# 初始化 LLM 端点池（支持多端点对冲与故障切换）
+llm_pool = EndpointPool.from_env()
+
+# 模型档位：数据收集阶段用小模型，内容构建阶段或升级后用强模型，未配置时回退到 LLM_MODEL
+MODEL_TIERS = {
+    "fast": os.getenv("LLM_MODEL_FAST") or os.getenv("LLM_MODEL"),
+    "strong": os.getenv("LLM_MODEL_STRONG") or os.getenv("LLM_MODEL"),
+}
+
+# 统计用的阶段，summarize 为 get_page_summaries 内部的摘要调用
+PHASES = ("collect", "compose", "summarize")
+
+# 当前线程正在运行的 run_agent 的统计，供工具内部的 LLM 调用记账
+_run_state = threading.local()
+_stats_lock = threading.Lock()
+
+# 属于内容构建阶段的工具
+COMPOSE_FUNCTIONS = {"append_text", "append_page_mention", "finish_rich_text"}
+
+# 单个页面摘要的正文长度上限（字符）
+SUMMARY_INPUT_LIMIT = 8000
+
+
+def _summarize_page(title: str, text: str, stats: dict | None = None):
+    """调用小模型为单个页面生成简短摘要，耗时和 token 计入 stats 的 summarize 阶段"""
+    start = time.perf_counter()
+    response = llm_pool.chat(
+        "fast",
+        model=MODEL_TIERS["fast"],
+        messages=[
+            {"role": "system", "content": "用 1-3 句话概括下面这个 Notion 页面的主要内容，只输出摘要本身。"},
+            {"role": "user", "content": f"标题：{title}\n\n{text[:SUMMARY_INPUT_LIMIT]}"}
+        ]
+    )
+    if stats is not None:
+        with _stats_lock:
+            _record_call(stats["phases"]["summarize"], response, time.perf_counter() - start)
+    return (response.choices[0].message.content or "").strip()
+
+
+def get_page_summaries(page_ids: list):
+    """获取页面摘要，未修改的页面复用本地缓存"""
+    # 摘要在工作线程中并发生成，需要先取出当前运行的统计
+    stats = getattr(_run_state, "stats", None)
+    return summarize_pages_cached(
+        page_ids,
+        lambda title, text: _summarize_page(title, text, stats),
+        max_workers=int(os.getenv("LLM_CONCURRENCY", "4"))
+    )
+
 
 # 定义可用的工具函数
 tools = [
@@ -112,6 +164,96 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_page_text",
+            "description": "获取页面或块下所有内容（含嵌套子块）的纯文本，子块按层级缩进，子页面和页面引用会附带 ID。比 get_blocks 返回的 JSON 小得多，适合阅读长页面；超过 20000 字符时会截断并在末尾注明。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "block_id": {
+                        "type": "string",
+                        "description": "Notion 块或页面的 ID"
+                    }
+                },
+                "required": ["block_id"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_page_summaries",
+            "description": "获取多个页面的简短摘要，包含标题和最后编辑时间。摘要按最后编辑时间缓存在本地，未修改的页面不会重新读取正文，适合概览、周报等需要了解多个页面内容的场景。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "page_ids": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Notion 页面 ID 列表"
+                    }
+                },
+                "required": ["page_ids"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_database_schema",
+            "description": "获取 Notion 数据库的结构：标题、每个属性的名称、类型以及 select/status 等属性的可选项。构造 query_database 的 filter 和 sorts 前先调用。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "database_id": {
+                        "type": "string",
+                        "description": "Notion 数据库的 ID，可通过 search_pages(obj_type='database') 获得"
+                    }
+                },
+                "required": ["database_id"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "query_database",
+            "description": "查询 Notion 数据库中的行。filter 和 sorts 使用 Notion API 格式，由 Notion 服务端过滤和排序；可只返回指定属性。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "database_id": {
+                        "type": "string",
+                        "description": "Notion 数据库的 ID"
+                    },
+                    "filter": {
+                        "type": "object",
+                        "description": "Notion 过滤条件，例如 {\"and\": [{\"property\": \"截止日期\", \"date\": {\"this_week\": {}}}, {\"property\": \"状态\", \"status\": {\"does_not_equal\": \"完成\"}}]}"
+                    },
+                    "sorts": {
+                        "type": "array",
+                        "items": {"type": "object"},
+                        "description": "排序规则，例如 [{\"property\": \"截止日期\", \"direction\": \"ascending\"}]"
+                    },
+                    "properties": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "只返回这些属性，默认返回全部属性"
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "返回行数上限，默认为 50，最大 500",
+                        "minimum": 1,
+                        "maximum": 500,
+                        "default": 50
+                    }
+                },
+                "required": ["database_id"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -170,23 +312,153 @@ available_functions = {
     "search_pages": search_pages,
     "get_page_properties": get_page_properties,
     "get_blocks": get_blocks,
+    "get_page_text": get_page_text,
+    "get_page_summaries": get_page_summaries,
+    "get_database_schema": get_database_schema,
+    "query_database": query_database,
     "append_text": append_text,
     "append_page_mention": append_page_mention,
     "finish_rich_text": finish_rich_text,
 }
 
+# 各工具声明的参数 schema，用于调用前校验
+_tool_schemas = {t["function"]["name"]: t["function"]["parameters"] for t in tools}
+
+
+# JSON Schema 类型到 Python 类型的映射（bool 是 int 的子类，需单独排除）
+_JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+}
 
-def run_agent(user_prompt: str, max_iterations: int = 50):
+
+def _check_value(name: str, value, schema: dict):
+    """按 schema 校验单个参数值，返回错误信息或 None"""
+    expected = schema.get("type")
+    if expected in _JSON_TYPES:
+        is_bool = isinstance(value, bool)
+        if not isinstance(value, _JSON_TYPES[expected]) or (is_bool and expected != "boolean"):
+            return f"'{name}' should be {expected}, got {type(value).__name__}"
+    if "enum" in schema and value not in schema["enum"]:
+        return f"'{name}' must be one of {schema['enum']}"
+    if "minimum" in schema and value < schema["minimum"]:
+        return f"'{name}' must be >= {schema['minimum']}"
+    if "maximum" in schema and value > schema["maximum"]:
+        return f"'{name}' must be <= {schema['maximum']}"
+    if expected == "array" and "items" in schema:
+        for i, item in enumerate(value):
+            error = _check_value(f"{name}[{i}]", item, schema["items"])
+            if error:
+                return error
+    return None
+
+
+def _check_args(function_name: str, function_args: dict):
+    """按 tools 中声明的 parameters 校验参数：必填项、类型、枚举和取值范围"""
+    schema = _tool_schemas[function_name]
+    params = inspect.signature(available_functions[function_name]).parameters
+    for name in schema.get("required", []):
+        if name not in function_args:
+            return f"Missing required argument: '{name}'"
+    for name, value in function_args.items():
+        prop = schema.get("properties", {}).get(name)
+        if prop is None:
+            continue
+        # 默认值为 None 的可选参数允许显式传 null
+        if value is None and name in params and params[name].default is None:
+            continue
+        error = _check_value(name, value, prop)
+        if error:
+            return f"Invalid arguments: {error}"
+    return None
+
+
+def _parse_tool_call(tool_call):
+    """
+    解析并校验工具调用参数
+
+    Returns:
+        (参数字典, 错误信息)，参数合法时错误信息为 None
+    """
+    function_name = tool_call.function.name
+    if function_name not in available_functions:
+        return None, f"Unknown function: {function_name}"
+    try:
+        function_args = json.loads(tool_call.function.arguments or "{}")
+    except json.JSONDecodeError as e:
+        return None, f"Invalid JSON arguments: {e}"
+    if not isinstance(function_args, dict):
+        return None, "Arguments must be a JSON object"
+    try:
+        inspect.signature(available_functions[function_name]).bind(**function_args)
+    except TypeError as e:
+        return None, f"Invalid arguments: {e}"
+    error = _check_args(function_name, function_args)
+    if error:
+        return None, error
+    return function_args, None
+
+
+def _new_phase_stats():
+    return {
+        phase: {"calls": 0, "latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+        for phase in PHASES
+    }
+
+
+def _record_call(phase_stats: dict, response, latency: float):
+    """把一次 LLM 调用的耗时和 token 计入对应阶段"""
+    phase_stats["calls"] += 1
+    phase_stats["latency"] += latency
+    if response.usage:
+        phase_stats["prompt_tokens"] += response.usage.prompt_tokens or 0
+        phase_stats["completion_tokens"] += response.usage.completion_tokens or 0
+
+
+def _print_phase_stats(stats: dict):
+    """打印各阶段的调用次数、耗时和 token 消耗"""
+    print("\n=== 分阶段统计 ===")
+    for phase, s in stats["phases"].items():
+        print(
+            f"{phase}: 调用 {s['calls']} 次, 耗时 {s['latency']:.2f}s, "
+            f"prompt tokens {s['prompt_tokens']}, completion tokens {s['completion_tokens']}"
+        )
+    print(f"小模型升级次数: {stats['escalations']}")
+    for name, s in llm_pool.stats().items():
+        print(f"端点 {name}: 健康度 {s['health']}, 成功 {s['successes']}, 失败 {s['failures']}")
+        for tier, t in s["tiers"].items():
+            print(
+                f"  {tier}: p50 {t['p50']}, p95 {t['p95']}, 期望延迟 {t['expected_latency']}s, "
+                f"延迟直方图 {t['histogram']}"
+            )
+
+
+def run_agent(user_prompt: str, max_iterations: int = 50, stats: dict | None = None):
     """
     运行智能体，根据用户提示生成 rich_text
 
+    数据收集阶段使用 MODEL_TIERS["fast"]，一旦模型开始调用 append_* / finish_rich_text
+    即切换到 MODEL_TIERS["strong"] 重新生成；小模型给出非法工具参数时自动升级到强模型。
+    统计按每次响应本身划分阶段：包含 append_* / finish_rich_text（或不再调用工具）的响应
+    记为 compose，其余记为 collect，与所用模型无关。
+
     Args:
         user_prompt: 用户的需求描述
         max_iterations: 最大迭代次数，防止无限循环
+        stats: 可选，传入字典时写入分阶段的耗时与 token 统计
 
     Returns:
         生成的 rich_text 列表
     """
+    if stats is None:
+        stats = {}
+    stats.update({"phases": _new_phase_stats(), "escalations": 0})
+    _run_state.stats = stats
+
     # 自动清空缓冲区，开始新的构建
     clear_rich_text()
 
@@ -211,15 +483,30 @@ def run_agent(user_prompt: str, max_iterations: int = 50):
             - block_id: 页面或块 ID
             - recursive: 是否递归获取子块（true/false）
 
+            5. `get_page_text(block_id)` - 获取页面全部内容的纯文本（含嵌套子块）
+            - 需要阅读页面正文时优先使用，比 get_blocks 更省篇幅
+            - 超过 20000 字符的内容会被截断，末尾会注明原始长度
+
+            6. `get_page_summaries(page_ids)` - 获取多个页面的简短摘要（带缓存）
+            - page_ids: 页面 ID 列表
+            - 只需了解页面大意时（如概览最近更新）优先使用，需要具体细节时再用 get_blocks
+
+            7. `get_database_schema(database_id)` - 获取数据库的属性名、类型和可选项
+
+            8. `query_database(database_id, filter, sorts, properties, limit)` - 查询数据库中的行
+            - filter / sorts: Notion API 格式，属性名必须与 get_database_schema 返回的一致
+            - properties: 只返回需要的属性
+            - 回答"本周到期的任务"这类问题时，用 filter 让 Notion 过滤，不要逐页读取
+
             **【内容构建工具】**
-            5. `append_text(text, bold)` - 添加文本内容
+            9. `append_text(text, bold)` - 添加文本内容
             - text: 文本内容，使用 \\n 表示换行
             - bold: 是否加粗（true/false）
 
-            6. `append_page_mention(page_id)` - 添加页面引用链接
+            10. `append_page_mention(page_id)` - 添加页面引用链接
             - page_id: 要引用的页面 ID
 
-            7. `finish_rich_text()` - **完成构建，返回最终结果**（必须是最后一步）
+            11. `finish_rich_text()` - **完成构建，返回最终结果**（必须是最后一步）
 
             ## 工作流程（严格遵守）
 
@@ -296,24 +583,53 @@ def run_agent(user_prompt: str, max_iterations: int = 50):
 
     iteration = 0
     rich_text_result = None
+    composing = False
+    escalated = False
 
     while iteration < max_iterations:
         iteration += 1
-        print(f"\n=== 迭代 {iteration} ===")
+        # 两档模型相同时无需切换，也就谈不上升级
+        use_fast = not composing and not escalated and MODEL_TIERS["fast"] != MODEL_TIERS["strong"]
+        tier = "fast" if use_fast else "strong"
+        model = MODEL_TIERS[tier]
+        print(f"\n=== 迭代 {iteration}（{tier} / {model}） ===")
 
         # 调用 OpenAI API
-        response = client.chat.completions.create(
-            model=os.getenv("LLM_MODEL"),
+        start = time.perf_counter()
+        # 并发上限（LLM_CONCURRENCY）由端点池统一控制，对冲请求同样计入
+        response = llm_pool.chat(
+            tier,
+            model=model,
             messages=messages,
             tools=tools,
             tool_choice="auto"
         )
+        latency = time.perf_counter() - start
 
         response_message = response.choices[0].message
-        messages.append(response_message)
 
         # 检查是否需要调用工具
-        tool_calls = response_message.tool_calls
+        tool_calls = response_message.tool_calls or []
+        parsed_calls = [(tool_call, *_parse_tool_call(tool_call)) for tool_call in tool_calls]
+
+        # 按响应内容划分阶段，与所用模型无关
+        is_compose = not tool_calls or any(tc.function.name in COMPOSE_FUNCTIONS for tc in tool_calls)
+        _record_call(stats["phases"]["compose" if is_compose else "collect"], response, latency)
+        composing = composing or is_compose
+
+        if use_fast:
+            # 小模型开始构建回答（或直接回答），丢弃本次结果，交给强模型重新生成
+            if is_compose:
+                print("进入内容构建阶段，切换到强模型")
+                continue
+            # 小模型给出了非法参数，升级到强模型重试
+            if any(error for _, _, error in parsed_calls):
+                print("小模型工具参数无效，升级到强模型")
+                escalated = True
+                stats["escalations"] += 1
+                continue
+
+        messages.append(response_message)
 
         if not tool_calls:
             # 没有工具调用，说明已完成
@@ -321,14 +637,20 @@ def run_agent(user_prompt: str, max_iterations: int = 50):
             break
 
         # 执行工具调用
-        for tool_call in tool_calls:
+        for tool_call, function_args, error in parsed_calls:
             function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
 
             print(f"调用函数: {function_name}")
             print(f"参数: {function_args}")
 
-            if function_name in available_functions:
+            if error:
+                print(f"函数调用错误: {error}")
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": f"Error: {error}"
+                })
+            else:
                 function_to_call = available_functions[function_name]
 
                 # 调用函数
@@ -363,6 +685,7 @@ def run_agent(user_prompt: str, max_iterations: int = 50):
                         "content": f"Error: {str(e)}"
                     })
 
+    _print_phase_stats(stats)
     return rich_text_result
 
 
@@ -392,12 +715,14 @@ def generate_rich_text(prompt: str):
     return rich_text
 
 
-def ask_question(question: str):
+def ask_question(question: str, block_id: str | None = None, stats: dict | None = None):
     """
     向智能体提问，自动搜索相关信息并生成 rich_text 格式的回答
 
     Args:
         question: 用户的问题
+        block_id: 要更新的 Notion block，默认使用 notion_config.json 中的 target_block
+        stats: 可选，传入字典时写入分阶段的耗时与 token 统计
 
     Returns:
         生成的 rich_text 列表
@@ -405,7 +730,7 @@ def ask_question(question: str):
     print(f"问题: {question}\n")
 
     # 运行智能体
-    rich_text = run_agent(question)
+    rich_text = run_agent(question, stats=stats)
 
     if rich_text:
         print("\n=== 生成的回答（Rich Text） ===")
@@ -413,7 +738,7 @@ def ask_question(question: str):
 
         # 更新 Notion block
         print("\n=== 更新到 Notion Block ===")
-        change_block(rich_text)
+        change_block(rich_text, block_id)
         print("✓ 回答已更新到 Notion")
     else:
         print("未能生成回答")
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from agent import run_agent
+from tools import change_block
+
+# 输出文件写入锁，保证每行结果完整
+_write_lock = threading.Lock()
+
+
+def load_prompts(path: str):
+    """
+    读取 JSONL 格式的问题列表
+
+    每行格式：{"id": "...", "prompt": "...", "target_block": "..."}
+    id 缺省时使用行号，target_block 缺省时使用 notion_config.json 中的 target_block
+
+    在开始处理前校验整个文件，格式错误、缺少 prompt 或 id 重复时直接报出行号，
+    避免跑到一半才失败。
+
+    Returns:
+        问题字典列表
+    """
+    items = []
+    seen_ids = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path} 第 {line_no} 行不是合法的 JSON: {e}")
+            if not isinstance(item, dict) or not isinstance(item.get("prompt"), str) or not item["prompt"]:
+                raise ValueError(f"{path} 第 {line_no} 行缺少 prompt")
+            item["id"] = str(item.get("id", line_no))
+            if item["id"] in seen_ids:
+                raise ValueError(f"{path} 第 {line_no} 行的 id {item['id']!r} 重复")
+            seen_ids.add(item["id"])
+            items.append(item)
+    return items
+
+
+def load_finished_ids(path: str):
+    """读取已有输出文件中成功完成的 id，用于断点续跑"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时可能留下半行，忽略即可
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["id"])
+    return finished
+
+
+def process_item(item: dict):
+    """处理单个问题：运行智能体并更新目标 block，返回结果记录"""
+    record = {
+        "id": item["id"],
+        "prompt": item["prompt"],
+        "target_block": item.get("target_block"),
+    }
+    stats = {}
+    start = time.perf_counter()
+    try:
+        rich_text = run_agent(item["prompt"], stats=stats)
+        agent_done = time.perf_counter()
+        if not rich_text:
+            raise RuntimeError("未能生成 rich_text")
+        response = change_block(rich_text, item.get("target_block"))
+        if response.get("object") == "error":
+            raise RuntimeError(response.get("message", "Notion API error"))
+        record.update({"status": "ok", "rich_text": rich_text})
+        record["timings"] = {
+            "agent": round(agent_done - start, 3),
+            "notion_update": round(time.perf_counter() - agent_done, 3),
+        }
+    except Exception as e:
+        record.update({"status": "error", "error": str(e)})
+        record["timings"] = {}
+    record["timings"]["total"] = round(time.perf_counter() - start, 3)
+    record["phases"] = stats.get("phases", {})
+    return record
+
+
+def run_batch(input_path: str, output_path: str, workers: int = 4):
+    """
+    并发处理 JSONL 中的所有问题，结果逐行追加到输出 JSONL
+
+    Notion 与 LLM 的并发上限分别由 NOTION_CONCURRENCY、LLM_CONCURRENCY 控制，
+    已获取的页面和块在所有问题之间共享。输出文件中已成功的 id 会被跳过，可直接重跑续上。
+
+    Args:
+        input_path: 输入 JSONL 路径
+        output_path: 输出 JSONL 路径
+        workers: 同时处理的问题数量
+    """
+    items = load_prompts(input_path)
+    finished = load_finished_ids(output_path)
+    pending = [item for item in items if item["id"] not in finished]
+    print(f"共 {len(items)} 个问题，已完成 {len(items) - len(pending)} 个，待处理 {len(pending)} 个")
+
+    ok = 0
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_item, item) for item in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            with _write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+            if record["status"] == "ok":
+                ok += 1
+            print(f"[{record['id']}] {record['status']} ({record['timings']['total']}s)")
+
+    print(f"\n✓ 批量处理完成：成功 {ok} 个，失败 {len(pending) - ok} 个")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量向智能体提问")
+    parser.add_argument("input", help="输入 JSONL，每行包含 prompt 和可选的 id、target_block")
+    parser.add_argument("output", help="输出 JSONL，记录每个问题的结果和耗时")
+    parser.add_argument("--workers", type=int, default=4, help="同时处理的问题数量，默认为 4")
+    args = parser.parse_args()
+
+    run_batch(args.input, args.output, args.workers)
@@ -0,0 +1,294 @@
+import sys
+
+# 标题不在 rich_text 中、而在 title 字段里的块类型
+TITLE_TYPES = {"child_page", "child_database"}
+
+# 内容放在 file / external 子对象中的块类型，保留其 url
+FILE_TYPES = {"image", "video", "audio", "file", "pdf"}
+
+# 类型相关字段中不需要保留的键
+SKIPPED_KEYS = {"rich_text", "title", "color", "caption", "children"}
+
+
+def _rich_text(rich_text: list):
+    """
+    拼接 rich_text 的纯文本，并记录其中页面/数据库引用的位置
+
+    Returns:
+        (纯文本, 引用片段)，引用片段为 (起始偏移, 结束偏移, 类型, ID) 元组，没有引用时为 None
+    """
+    parts = []
+    segments = []
+    pos = 0
+    for segment in rich_text:
+        text = segment.get("plain_text", "")
+        mention = segment.get("mention") if segment.get("type") == "mention" else None
+        if mention and mention.get("type") in ("page", "database"):
+            mention_type = sys.intern(mention["type"])
+            segments.append((pos, pos + len(text), mention_type, mention[mention_type].get("id")))
+        parts.append(text)
+        pos += len(text)
+    return "".join(parts), tuple(segments) or None
+
+
+def _block_attrs(block_type: str, content: dict):
+    """提取类型相关的标量字段，例如 to_do 的 checked、code 的 language、bookmark 的 url"""
+    attrs = {
+        key: value for key, value in content.items()
+        if key not in SKIPPED_KEYS and isinstance(value, (str, int, float, bool))
+    }
+    if block_type in FILE_TYPES:
+        attrs.pop("type", None)
+        url = content.get(content.get("type"), {}).get("url")
+        if url:
+            attrs["url"] = url
+    return attrs or None
+
+
+class BlockNode:
+    """紧凑的块节点：只保留结构信息，正文存放在所属 BlockTree 的文本缓冲区中"""
+
+    __slots__ = ("id", "type", "has_children", "start", "end", "attrs", "mentions", "children")
+
+    def __init__(self, id: str, type: str, has_children: bool, start: int, end: int,
+                 attrs: dict | None = None, mentions: tuple | None = None):
+        self.id = id
+        self.type = type
+        self.has_children = has_children
+        self.start = start
+        self.end = end
+        # 类型相关的标量字段，大多数块（段落、标题等）没有，为 None
+        self.attrs = attrs
+        # 页面/数据库引用片段（相对本块文本的偏移），没有引用时为 None
+        self.mentions = mentions
+        self.children = None
+
+
+class BlockTree:
+    """
+    紧凑的块树
+
+    块类型字符串会被 intern，所有块的纯文本拼接在一个缓冲区中，节点只记录偏移量；
+    子页面标题、页面引用的 ID 和 checked、url 等标量字段会保留，
+    原始 JSON 中的 user、parent、annotations 等对象不会保留。
+    """
+
+    __slots__ = ("roots", "_parts", "_length")
+
+    def __init__(self):
+        self.roots = []
+        self._parts = []
+        self._length = 0
+
+    @classmethod
+    def from_blocks(cls, blocks: list):
+        """从已经带 children 的原始块列表构建"""
+        tree = cls()
+        stack = [(b, None) for b in reversed(blocks)]
+        while stack:
+            block, parent = stack.pop()
+            node = tree.add(block, parent)
+            stack.extend((child, node) for child in reversed(block.get("children", [])))
+        return tree
+
+    def add(self, block: dict, parent: BlockNode | None = None):
+        """把一个原始块加入树中，返回对应的节点；原始 dict 之后即可丢弃"""
+        block_type = block.get("type", "")
+        content = block.get(block_type, {})
+        if block_type in TITLE_TYPES:
+            text, mentions = content.get("title", ""), None
+        else:
+            text, mentions = _rich_text(content.get("rich_text", []))
+
+        start = self._length
+        if text:
+            self._parts.append(text)
+            self._length += len(text)
+        node = BlockNode(
+            block["id"], sys.intern(block_type), bool(block.get("has_children")),
+            start, self._length, _block_attrs(block_type, content), mentions
+        )
+
+        if parent is None:
+            self.roots.append(node)
+        else:
+            if parent.children is None:
+                parent.children = []
+            parent.children.append(node)
+        return node
+
+    @property
+    def text(self):
+        """整个文本缓冲区，按需合并成单个字符串"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def node_text(self, node: BlockNode):
+        return self.text[node.start:node.end]
+
+    def __iter__(self):
+        """深度优先遍历，返回 (节点, 层级)"""
+        stack = [(node, 0) for node in reversed(self.roots)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            if node.children:
+                stack.extend((child, depth + 1) for child in reversed(node.children))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def line(self, node: BlockNode):
+        """单个块的一行纯文本，附带子页面 ID、待办状态和 url 等信息"""
+        content = self.text[node.start:node.end]
+        # 引用后附带 ID，便于模型调用 append_page_mention；从后往前插入，偏移不受影响
+        for _, end, _, target_id in reversed(node.mentions or ()):
+            content = f"{content[:end]}(id: {target_id}){content[end:]}"
+        attrs = node.attrs or {}
+        if node.type == "to_do":
+            content = ("[x] " if attrs.get("checked") else "[ ] ") + content
+        elif node.type in TITLE_TYPES:
+            content = f"{content}(id: {node.id})"
+        elif node.type == "code" and attrs.get("language"):
+            content = f"[{attrs['language']}] {content}"
+        if attrs.get("url"):
+            content = f"{content} {attrs['url']}".strip()
+        return content
+
+    def to_text(self):
+        """转为给 LLM 阅读的纯文本，子块按层级缩进"""
+        lines = []
+        for node, depth in self:
+            content = self.line(node)
+            if content:
+                lines.append("  " * depth + content)
+        return "\n".join(lines)
+
+    def to_dicts(self):
+        """转回与 Notion 块结构相近的 dict 列表（id、类型、纯文本与页面引用、标量字段和子块，不含格式）"""
+        text = self.text
+
+        def text_segment(content: str):
+            return {"type": "text", "text": {"content": content}, "plain_text": content}
+
+        def rich_text(node: BlockNode):
+            content = text[node.start:node.end]
+            segments = []
+            pos = 0
+            for start, end, mention_type, target_id in node.mentions or ():
+                if start > pos:
+                    segments.append(text_segment(content[pos:start]))
+                segments.append({
+                    "type": "mention",
+                    "mention": {"type": mention_type, mention_type: {"id": target_id}},
+                    "plain_text": content[start:end]
+                })
+                pos = end
+            if pos < len(content):
+                segments.append(text_segment(content[pos:]))
+            return segments
+
+        def convert(node: BlockNode):
+            if node.type in TITLE_TYPES:
+                type_content = {"title": text[node.start:node.end]}
+            else:
+                type_content = {"rich_text": rich_text(node)}
+            if node.attrs:
+                type_content.update(node.attrs)
+            block = {
+                "id": node.id,
+                "type": node.type,
+                "has_children": node.has_children,
+                node.type: type_content
+            }
+            if node.children:
+                block["children"] = [convert(child) for child in node.children]
+            return block
+
+        return [convert(node) for node in self.roots]
+
+
+def _synthetic_blocks(count: int, fanout: int = 5):
+    """生成与 Notion API 返回结构相近的块，用于基准测试"""
+    user = {"object": "user", "id": "9f1b2c3d-0000-4000-8000-000000000000"}
+    annotations = {"bold": False, "italic": False, "strikethrough": False,
+                   "underline": False, "code": False, "color": "default"}
+
+    def block(i: int, parent_id: str):
+        content = f"第 {i} 段内容，包含一些用于测试的正文文字。"
+        return {
+            "object": "block",
+            "id": f"00000000-0000-4000-8000-{i:012d}",
+            "parent": {"type": "block_id", "block_id": parent_id},
+            "created_time": "2025-01-01T00:00:00.000Z",
+            "last_edited_time": "2025-01-02T00:00:00.000Z",
+            "created_by": dict(user),
+            "last_edited_by": dict(user),
+            "has_children": False,
+            "archived": False,
+            "in_trash": False,
+            "type": "paragraph",
+            "paragraph": {
+                "rich_text": [{
+                    "type": "text",
+                    "text": {"content": content, "link": None},
+                    "annotations": dict(annotations),
+                    "plain_text": content,
+                    "href": None
+                }],
+                "color": "default"
+            }
+        }
+
+    roots = []
+    parents = []
+    for i in range(count):
+        if parents and i % (fanout + 1):
+            parent = parents[(i // (fanout + 1)) % len(parents)]
+            parent["has_children"] = True
+            parent.setdefault("children", []).append(block(i, parent["id"]))
+        else:
+            b = block(i, "page")
+            roots.append(b)
+            parents.append(b)
+    return roots
+
+
+if __name__ == "__main__":
+    # 基准测试：原始 dict 树与紧凑块树的内存占用，以及两者输出 JSON、紧凑树输出纯文本的耗时
+    import json
+    import time
+    import tracemalloc
+
+    for count in (1000, 5000, 20000):
+        payload = json.dumps(_synthetic_blocks(count))
+
+        tracemalloc.start()
+        raw = json.loads(payload)
+        raw_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        tree = BlockTree.from_blocks(json.loads(payload))
+        compact_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        json.dumps(raw, ensure_ascii=False)
+        raw_dump = time.perf_counter() - start
+
+        # 同样输出 JSON 的对比：紧凑树转回 dict 再序列化
+        start = time.perf_counter()
+        json.dumps(tree.to_dicts(), ensure_ascii=False)
+        compact_dump = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree.to_text()
+        compact_text = time.perf_counter() - start
+
+        print(
+            f"{count} 个块: dict 树 {raw_size / 1024 / 1024:.1f} MB / 序列化 {raw_dump * 1000:.1f} ms; "
+            f"紧凑树 {compact_size / 1024 / 1024:.1f} MB / to_dicts+序列化 {compact_dump * 1000:.1f} ms / "
+            f"转文本 {compact_text * 1000:.1f} ms"
+        )
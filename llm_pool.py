@@ -0,0 +1,274 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from openai import OpenAI
+
+# 延迟直方图的分桶上界（秒）
+HISTOGRAM_BOUNDS = [0.5, 1, 2, 5, 10, 30, float("inf")]
+
+# 样本数不足时，按百分位计算对冲延迟不可靠，改用固定值
+MIN_SAMPLES = 5
+
+# 直方图每记录一次样本，旧样本的权重衰减系数
+HISTOGRAM_DECAY = 0.95
+
+# 路由用的延迟先验：没有样本的端点按 PRIOR_LATENCY 秒估计，权重相当于 PRIOR_WEIGHT 个样本
+PRIOR_LATENCY = 5.0
+PRIOR_WEIGHT = 2.0
+
+# 端点空闲时，健康度和历史样本的影响按此半衰期（秒）回归先验，失败过的端点因此会被重新尝试
+RECOVERY_HALF_LIFE = 60.0
+
+# 请求仍在排队等待并发名额时，检查其是否已开始的间隔（秒）
+QUEUE_POLL_INTERVAL = 0.05
+
+
+class Endpoint:
+    """一个 OpenAI 兼容端点，记录自身的延迟分布和健康度"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, models: dict | None = None, timeout: float = 60):
+        self.name = name
+        self.timeout = timeout
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url.replace("/chat/completions", ""),
+            timeout=timeout,
+            max_retries=0
+        )
+        # 按模型档位覆盖模型名，例如 {"fast": "gpt-4o-mini", "strong": "gpt-4o"}
+        self.models = models or {}
+        # 延迟样本和带衰减的直方图按档位分开记录，失败计入最后一档；健康度按端点整体记录
+        self.latencies = {}
+        self.histograms = {}
+        self.health = 1.0
+        self.last_recorded = time.monotonic()
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, tier: str, latency: float, ok: bool):
+        """记录一次请求结果，健康度按指数滑动平均更新"""
+        with self._lock:
+            self.health = 0.8 * self._recovered_health() + 0.2 * (1.0 if ok else 0.0)
+            self.last_recorded = time.monotonic()
+            histogram = [count * HISTOGRAM_DECAY for count in self.histograms.get(tier, [0.0] * len(HISTOGRAM_BOUNDS))]
+            if ok:
+                self.successes += 1
+                self.latencies.setdefault(tier, deque(maxlen=200)).append(latency)
+                for i, bound in enumerate(HISTOGRAM_BOUNDS):
+                    if latency <= bound:
+                        histogram[i] += 1
+                        break
+            else:
+                self.failures += 1
+                histogram[-1] += 1
+            self.histograms[tier] = histogram
+
+    def _recovery_weight(self):
+        """距上次记录越久，历史数据的权重越低"""
+        return 0.5 ** ((time.monotonic() - self.last_recorded) / RECOVERY_HALF_LIFE)
+
+    def _recovered_health(self):
+        return 1.0 - (1.0 - self.health) * self._recovery_weight()
+
+    def percentile(self, tier: str, p: float):
+        """返回该档位最近延迟的第 p 百分位，样本不足时返回 None"""
+        with self._lock:
+            latencies = self.latencies.get(tier, ())
+            if len(latencies) < MIN_SAMPLES:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def expected_latency(self, tier: str):
+        """
+        由该档位的直方图估计的期望延迟
+
+        每档取其上界（最后一档按超时时间），并与先验按权重混合：没有样本的端点
+        按先验估计，而不是当作零延迟；长时间空闲后历史样本的权重也会逐渐回落。
+        """
+        with self._lock:
+            weight = self._recovery_weight()
+            histogram = self.histograms.get(tier, [])
+            bounds = HISTOGRAM_BOUNDS[:-1] + [self.timeout]
+            observed = sum(count * bound for count, bound in zip(histogram, bounds)) * weight
+            samples = sum(histogram) * weight
+        return (observed + PRIOR_LATENCY * PRIOR_WEIGHT) / (samples + PRIOR_WEIGHT)
+
+    def score(self, tier: str):
+        """路由得分：健康度越高、该档位期望延迟越低越优先"""
+        with self._lock:
+            health = self._recovered_health()
+        return health / (1.0 + self.expected_latency(tier))
+
+    def complete(self, tier: str, **kwargs):
+        if tier in self.models:
+            kwargs["model"] = self.models[tier]
+        return self.client.chat.completions.create(**kwargs)
+
+
+class EndpointPool:
+    """
+    多端点 LLM 请求池
+
+    主端点开始处理（拿到并发名额）后，在对冲延迟（其历史延迟的指定百分位）内未返回时，向次优端点发送一份相同请求，
+    取最先返回的有效结果，其余请求取消或丢弃；请求失败时依次切换到后续端点。
+
+    max_concurrency 限制的是真正发往上游的请求数：对冲请求和已被放弃但仍在运行的请求
+    同样占用名额，直到它们结束。
+    """
+
+    def __init__(self, endpoints: list, hedge_percentile: float = 95, default_hedge_delay: float = 8,
+                 max_concurrency: int = 4):
+        if not endpoints:
+            raise ValueError("至少需要配置一个 LLM 端点")
+        self.endpoints = endpoints
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # 被放弃的请求仍会在后台跑完（受端点超时约束），线程数需留出余量
+        self._executor = ThreadPoolExecutor(max_workers=8 * len(endpoints))
+
+    @classmethod
+    def from_env(cls):
+        """
+        从环境变量构建端点池
+
+        LLM_ENDPOINTS 为 JSON 列表，每项包含 name、base_url、api_key 和可选的 models；
+        未配置时使用 LLM_BASE_URL / LLM_API_KEY 作为唯一端点。
+        """
+        timeout = float(os.getenv("LLM_TIMEOUT", "60"))
+        configs = json.loads(os.getenv("LLM_ENDPOINTS") or "[]")
+        if not configs:
+            configs = [{
+                "name": "default",
+                "base_url": os.getenv("LLM_BASE_URL"),
+                "api_key": os.getenv("LLM_API_KEY"),
+            }]
+        endpoints = [
+            Endpoint(
+                name=c.get("name", c["base_url"]),
+                base_url=c["base_url"],
+                api_key=c["api_key"],
+                models=c.get("models"),
+                timeout=c.get("timeout", timeout)
+            )
+            for c in configs
+        ]
+        return cls(
+            endpoints,
+            hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "95")),
+            default_hedge_delay=float(os.getenv("LLM_HEDGE_DELAY", "8")),
+            max_concurrency=int(os.getenv("LLM_CONCURRENCY", "4"))
+        )
+
+    def _submit(self, endpoint: Endpoint, tier: str, kwargs: dict):
+        # 拿到并发名额、真正发往上游的时间，对冲计时从这里开始
+        started = {"at": None}
+
+        def call():
+            with self._slots:
+                started["at"] = time.monotonic()
+                start = time.perf_counter()
+                try:
+                    response = endpoint.complete(tier, **kwargs)
+                except Exception:
+                    endpoint.record(tier, time.perf_counter() - start, ok=False)
+                    raise
+                ok = bool(response.choices)
+                endpoint.record(tier, time.perf_counter() - start, ok=ok)
+            if not ok:
+                raise RuntimeError(f"{endpoint.name} 返回了空结果")
+            return response
+
+        future = self._executor.submit(call)
+        future.endpoint = endpoint
+        future.started = started
+        return future
+
+    def _hedge_delay(self, endpoint: Endpoint, tier: str):
+        return endpoint.percentile(tier, self.hedge_percentile) or self.default_hedge_delay
+
+    def chat(self, tier: str, **kwargs):
+        """
+        发送 chat completion 请求，参数与 client.chat.completions.create 相同
+
+        Args:
+            tier: 模型档位（"fast" / "strong"），用于选择端点上按档位配置的模型
+
+        Returns:
+            最先返回的有效响应
+        """
+        ranked = sorted(self.endpoints, key=lambda e: e.score(tier), reverse=True)
+        backups = deque(ranked[1:])
+        current = self._submit(ranked[0], tier, kwargs)
+        hedge_delay = self._hedge_delay(current.endpoint, tier)
+
+        pending = {current}
+        hedged = False
+        last_error = None
+
+        while pending:
+            if hedged or not backups:
+                timeout = None
+            elif current.started["at"] is None:
+                # 还在排队等并发名额，排队时间不计入对冲延迟
+                timeout = QUEUE_POLL_INTERVAL
+            else:
+                timeout = max(0.0, current.started["at"] + hedge_delay - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                started_at = current.started["at"]
+                if started_at is None or time.monotonic() < started_at + hedge_delay:
+                    continue
+                # 当前端点开始处理后超过对冲延迟仍未返回，向次优端点发送对冲请求
+                backup = backups.popleft()
+                print(f"{current.endpoint.name} 超过 {hedge_delay:.2f}s 未返回，对冲请求 {backup.name}")
+                pending.add(self._submit(backup, tier, kwargs))
+                hedged = True
+                continue
+
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    print(f"LLM 端点 {future.endpoint.name} 请求失败: {e}")
+                    continue
+                for other in pending:
+                    other.cancel()
+                return response
+
+            # 所有已完成的请求都失败了，切换到下一个端点，对冲计时按新端点重新开始
+            if not pending and backups:
+                current = self._submit(backups.popleft(), tier, kwargs)
+                hedge_delay = self._hedge_delay(current.endpoint, tier)
+                pending.add(current)
+                hedged = False
+
+        raise RuntimeError(f"所有 LLM 端点均请求失败: {last_error}")
+
+    def stats(self):
+        """返回各端点的健康度，以及按档位划分的延迟分位和直方图"""
+        labels = [f"<={bound}s" for bound in HISTOGRAM_BOUNDS[:-1]] + [f">{HISTOGRAM_BOUNDS[-2]}s"]
+        return {
+            e.name: {
+                "health": round(e.health, 3),
+                "successes": e.successes,
+                "failures": e.failures,
+                "tiers": {
+                    tier: {
+                        "p50": e.percentile(tier, 50),
+                        "p95": e.percentile(tier, 95),
+                        "expected_latency": round(e.expected_latency(tier), 2),
+                        "histogram": {label: round(count, 1) for label, count in zip(labels, histogram)},
+                    }
+                    for tier, histogram in list(e.histograms.items())
+                },
+            }
+            for e in self.endpoints
+        }
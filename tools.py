@@ -1,11 +1,103 @@
 import http.client
 import json
 import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+from blocks import BlockTree
 
 # 加载 .env 文件
 load_dotenv()
 
+# Notion API 并发上限，批量模式下多个问题共享
+_notion_semaphore = threading.BoundedSemaphore(int(os.getenv("NOTION_CONCURRENCY", "3")))
+
+# 遇到限流（429）或临时性服务端错误时的最大重试次数
+NOTION_MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "5"))
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 跨问题共享的页面/块缓存
+# 每个缓存最多保留的条目数，超出后淘汰最久未使用的条目，避免批量模式下无限增长
+NOTION_CACHE_SIZE = int(os.getenv("NOTION_CACHE_SIZE", "256"))
+_cache_lock = threading.Lock()
+_page_cache = OrderedDict()
+_blocks_cache = OrderedDict()
+_tree_cache = OrderedDict()
+_schema_cache = OrderedDict()
+
+
+def _cache_get(cache: OrderedDict, key):
+    """读取缓存并标记为最近使用，未命中返回 None"""
+    with _cache_lock:
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
+
+
+def _cache_put(cache: OrderedDict, key, value):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > NOTION_CACHE_SIZE:
+            cache.popitem(last=False)
+
+# query_database 单次最多返回的行数
+QUERY_ROW_CAP = 500
+
+# get_page_text 返回的最大字符数，超出部分截断并附带提示，避免超长页面撑爆上下文
+PAGE_TEXT_LIMIT = 20000
+
+# 页面摘要的本地缓存文件，按页面 id 和 last_edited_time 失效
+SUMMARY_CACHE_PATH = os.getenv("PAGE_SUMMARY_CACHE", "page_summaries.json")
+_summary_lock = threading.Lock()
+
+
+def _notion_request(method: str, path: str, body: dict | None = None):
+   """
+   发送 Notion API 请求并返回解析后的 JSON，受全局并发上限约束
+
+   限流（429）和临时性 5xx 会按 Retry-After 或指数退避重试，等待期间不占用并发名额；
+   重试耗尽后返回 Notion 的错误体（object == "error"）。
+   """
+   headers = {
+      'Authorization': os.getenv("NOTION_API_KEY"),
+      'Notion-Version': os.getenv("Notion-Version", "2022-06-28"),
+      'Content-Type': 'application/json',
+      'Accept': '*/*',
+      'Host': 'api.notion.com',
+      'Connection': 'keep-alive'
+   }
+   payload = json.dumps(body) if body is not None else ""
+   for attempt in range(NOTION_MAX_RETRIES + 1):
+      with _notion_semaphore:
+         conn = http.client.HTTPSConnection("api.notion.com")
+         try:
+            conn.request(method, path, payload, headers)
+            res = conn.getresponse()
+            status = res.status
+            retry_after = res.getheader("Retry-After")
+            raw = res.read().decode("utf-8")
+         finally:
+            conn.close()
+      try:
+         data = json.loads(raw)
+      except ValueError:
+         # 网关错误等可能返回非 JSON，统一成 Notion 错误体的格式
+         data = {"object": "error", "status": status, "message": raw[:200]}
+      if status not in _RETRY_STATUSES or attempt == NOTION_MAX_RETRIES:
+         return data
+      try:
+         delay = float(retry_after)
+      except (TypeError, ValueError):
+         delay = 2 ** attempt + random.random()
+      print(f"Notion API 返回 {status}，{delay:.1f}s 后重试（第 {attempt + 1} 次）")
+      time.sleep(delay)
+
 
 # 修改 notion_config.json 中的 block id
 def change_block_id(block_id: str):
@@ -16,56 +108,32 @@ def change_block_id(block_id: str):
       json.dump(config, f, indent=4)
 
 
-# 修改 Notion 中的指定 block 内容
-def change_block(rich_text:list):
-   with open('notion_config.json', 'r') as f:
-      config = json.load(f)
-   os.environ['BLOCK_ID'] = config['target_block']
-   blocks_url = f"/v1/blocks/{os.getenv('BLOCK_ID')}"
-   conn = http.client.HTTPSConnection("api.notion.com")
-   payload = json.dumps({
+# 修改 Notion 中的指定 block 内容，未指定 block_id 时使用 notion_config.json 中的 target_block
+def change_block(rich_text:list, block_id: str | None = None):
+   if block_id is None:
+      with open('notion_config.json', 'r') as f:
+         config = json.load(f)
+      block_id = config['target_block']
+   payload = {
       "callout": {
          "rich_text": rich_text
       }
-   })
+   }
 
    # 调试：打印发送的 payload
    print("\n=== 发送到 Notion 的 Payload ===")
    print(f"Rich text 元素数量: {len(rich_text)}")
-   print(f"Payload 前 500 字符: {payload[:500]}...")
+   print(f"Payload 前 500 字符: {json.dumps(payload)[:500]}...")
 
-   headers = {
-      'Authorization': os.getenv("NOTION_API_KEY"),
-      'Notion-Version': os.getenv("Notion-Version"),
-      'Content-Type': 'application/json',
-      'Accept': '*/*',
-      'Host': 'api.notion.com',
-      'Connection': 'keep-alive'
-   }
-   conn.request("PATCH", blocks_url, payload, headers)
-   res = conn.getresponse()
-   data = res.read().decode("utf-8")
+   data = _notion_request("PATCH", f"/v1/blocks/{block_id}", payload)
 
    print("\n=== Notion API 响应 ===")
    print(data)
+   return data
 
 # 查询 页面内容
 def get_page_content(page_id: str):
-   page_url = f"/v1/blocks/{page_id}/children?page_size=100"
-   conn = http.client.HTTPSConnection("api.notion.com")
-   payload = json.dumps({})
-   headers = {
-      'Authorization': os.getenv("NOTION_API_KEY"),
-      'Notion-Version': os.getenv("Notion-Version"),
-      'Content-Type': 'application/json',
-      'Accept': '*/*',
-      'Host': 'api.notion.com',
-      'Connection': 'keep-alive'
-   } 
-   conn.request("GET", page_url, payload, headers)
-   res = conn.getresponse()
-   data = json.loads(res.read().decode("utf-8"))
-   return data
+   return _notion_request("GET", f"/v1/blocks/{page_id}/children?page_size=100")
 
 
 # 获取最近修改的页面 ID
@@ -75,25 +143,13 @@ def get_lasted_change_page_id(page_size):
       config = json.load(f)
    target_page = config['target_page']
 
-   conn = http.client.HTTPSConnection("api.notion.com")
-   payload = json.dumps({
+   data = _notion_request("POST", "/v1/search", {
       "sort": {
          "timestamp": "last_edited_time",
          "direction": "descending"
       },
       "page_size": page_size+1
    })
-   headers = {
-      'Authorization': os.getenv("NOTION_API_KEY"),
-      'Notion-Version': os.getenv("Notion-Version"),
-      'Content-Type': 'application/json',
-      'Accept': '*/*',
-      'Host': 'api.notion.com',
-      'Connection': 'keep-alive'
-   }
-   conn.request("POST", "/v1/search", payload, headers)
-   res = conn.getresponse()
-   data = json.loads(res.read().decode("utf-8"))
    results = data.get("results", [])
 
    ## 过滤自己
@@ -131,8 +187,6 @@ def wrap_text(text: str,bold: bool =False):
 
 # 关键词搜索
 def search_pages(keyword: str = "", obj_type: str = "page", limit: int = 10):
-    conn = http.client.HTTPSConnection("api.notion.com")
-    
     # 构建请求 payload
     payload_dict = {
         "sort": {"timestamp": "last_edited_time", "direction": "descending"},
@@ -147,16 +201,7 @@ def search_pages(keyword: str = "", obj_type: str = "page", limit: int = 10):
     if obj_type:
         payload_dict["filter"] = {"value": obj_type, "property": "object"}
     
-    payload = json.dumps(payload_dict)
-    
-    headers = {
-        "Authorization": os.getenv("NOTION_API_KEY"),
-        "Notion-Version": os.getenv("Notion-Version", "2022-06-28"),
-        "Content-Type": "application/json"
-    }
-    conn.request("POST", "/v1/search", payload, headers)
-    res = conn.getresponse()
-    data = json.loads(res.read().decode())
+    data = _notion_request("POST", "/v1/search", payload_dict)
     
     results = []
     for item in data.get("results", []):
@@ -184,44 +229,303 @@ def search_pages(keyword: str = "", obj_type: str = "page", limit: int = 10):
 # 拉取页面属性
 
 def get_page_properties(page_id: str):
-    conn = http.client.HTTPSConnection("api.notion.com")
-    headers = {
-        "Authorization": os.getenv("NOTION_API_KEY"),
-        "Notion-Version": os.getenv("Notion-Version", "2022-06-28")
-    }
-    conn.request("GET", f"/v1/pages/{page_id}", "", headers)
-    res = conn.getresponse()
-    return json.loads(res.read().decode())
+    cached = _cache_get(_page_cache, page_id)
+    if cached is not None:
+        return cached
+    data = _notion_request("GET", f"/v1/pages/{page_id}")
+    if data.get("object") != "error":
+        _cache_put(_page_cache, page_id, data)
+    return data
  
 
 # 拿页面/块100条正文内容
 
 def get_blocks(block_id: str, recursive: bool = False):
-    """recursive=True 时自动再抓子块"""
-    conn = http.client.HTTPSConnection("api.notion.com")
-    headers = {
-        "Authorization": os.getenv("NOTION_API_KEY"),
-        "Notion-Version": os.getenv("Notion-Version", "2022-06-28")
-    }
-    conn.request("GET", f"/v1/blocks/{block_id}/children?page_size=100", "", headers)
-    res = conn.getresponse()
-    blocks = json.loads(res.read().decode()).get("results", [])
+    """
+    recursive=True 时自动再抓子块（每层最多 100 条）
+
+    递归结果由紧凑块树转换而来：保留 id、类型、纯文本、页面引用、子页面标题和
+    checked、url 等字段，不含格式和 user、parent 等对象；进程内只缓存紧凑树。
+    """
     if recursive:
-        for b in blocks:
-            if b.get("has_children"):
-                b["children"] = get_blocks(b["id"], recursive=True)
+        try:
+            return get_block_tree(block_id, paginate=False).to_dicts()
+        except RuntimeError as e:
+            return {"object": "error", "message": str(e)}
+    cached = _cache_get(_blocks_cache, block_id)
+    if cached is not None:
+        return cached
+    data = _notion_request("GET", f"/v1/blocks/{block_id}/children?page_size=100")
+    if data.get("object") == "error":
+        # 错误不缓存，避免后续问题一直拿到空内容
+        return data
+    blocks = data.get("results", [])
+    _cache_put(_blocks_cache, block_id, blocks)
     return blocks
 
 
+# 拉取块树，每页响应直接转为紧凑节点，不保留原始 JSON；任何一页出错都会抛出异常
+def get_block_tree(block_id: str, paginate: bool = True):
+    """paginate=False 时每层只取前 100 条，与 get_blocks 一致"""
+    key = (block_id, paginate)
+    cached = _cache_get(_tree_cache, key)
+    if cached is not None:
+        return cached
+
+    tree = BlockTree()
+    stack = [(block_id, None)]
+    while stack:
+        parent_id, parent = stack.pop()
+        cursor = None
+        while True:
+            path = f"/v1/blocks/{parent_id}/children?page_size=100"
+            if cursor:
+                path += f"&start_cursor={cursor}"
+            data = _notion_request("GET", path)
+            if data.get("object") == "error":
+                # 限流或无权限时直接报错，不缓存残缺的树
+                raise RuntimeError(f"Notion API error for block {parent_id}: {data.get('message', data)}")
+            for block in data.get("results", []):
+                node = tree.add(block, parent)
+                if node.has_children:
+                    stack.append((node.id, node))
+            if not paginate or not data.get("has_more"):
+                break
+            cursor = data.get("next_cursor")
+
+    _cache_put(_tree_cache, key, tree)
+    return tree
+
+
+# 页面全文的纯文本，比 get_blocks 的 JSON 小得多
+def get_page_text(block_id: str):
+    text = get_block_tree(block_id).to_text()
+    if len(text) > PAGE_TEXT_LIMIT:
+        text = (f"{text[:PAGE_TEXT_LIMIT]}\n...（内容过长，已截断：共 {len(text)} 字符，仅返回前 {PAGE_TEXT_LIMIT} 字符，"
+                f"如需其余内容，可先用 get_blocks 获取子块 ID 再分别读取）")
+    return text
+
+
+# 数据库结构：属性名、类型及可选项，进程内缓存，供模型构造合法的 filter
+def get_database_schema(database_id: str):
+    cached = _cache_get(_schema_cache, database_id)
+    if cached is not None:
+        return cached
+    data = _notion_request("GET", f"/v1/databases/{database_id}")
+    if data.get("object") == "error":
+        return data
+
+    properties = {}
+    for name, prop in data.get("properties", {}).items():
+        info = {"id": prop.get("id"), "type": prop.get("type")}
+        options = prop.get(prop.get("type"), {}).get("options")
+        if options:
+            info["options"] = [o.get("name") for o in options]
+        properties[name] = info
+    schema = {
+        "id": data["id"],
+        "title": "".join(t.get("plain_text", "") for t in data.get("title", [])),
+        "properties": properties
+    }
+    _cache_put(_schema_cache, database_id, schema)
+    return schema
+
+
+# 属性值转为简单值，去掉 Notion 返回中的冗余结构
+def _property_value(prop: dict):
+    prop_type = prop.get("type")
+    value = prop.get(prop_type)
+    if prop_type in ("title", "rich_text"):
+        return "".join(t.get("plain_text", "") for t in value or [])
+    if prop_type in ("select", "status"):
+        return value.get("name") if value else None
+    if prop_type == "multi_select":
+        return [o.get("name") for o in value or []]
+    if prop_type == "date":
+        if not value:
+            return None
+        return f"{value['start']} → {value['end']}" if value.get("end") else value.get("start")
+    if prop_type == "people":
+        return [p.get("name") or p.get("id") for p in value or []]
+    if prop_type == "relation":
+        return [r.get("id") for r in value or []]
+    if prop_type in ("formula", "rollup"):
+        return value.get(value.get("type")) if value else None
+    return value
+
+
+# 收集 filter / sorts 中引用的属性名
+def _referenced_properties(node):
+    if isinstance(node, dict):
+        names = [node["property"]] if isinstance(node.get("property"), str) else []
+        for v in node.values():
+            names.extend(_referenced_properties(v))
+        return names
+    if isinstance(node, list):
+        return [name for item in node for name in _referenced_properties(item)]
+    return []
+
+
+# 查询数据库：filter 和 sorts 直接交给 Notion 处理，自动翻页直到达到 limit
+def query_database(database_id: str, filter: dict | None = None, sorts: list | None = None,
+                   properties: list | None = None, limit: int = 50):
+    schema = get_database_schema(database_id)
+    if schema.get("object") == "error":
+        return schema
+
+    # 先在本地校验属性名，避免一次无效的往返
+    known = schema["properties"]
+    unknown = [
+        name for name in _referenced_properties(filter) + _referenced_properties(sorts) + (properties or [])
+        if name not in known
+    ]
+    if unknown:
+        return {
+            "error": f"Unknown properties: {sorted(set(unknown))}",
+            "available_properties": {name: info["type"] for name, info in known.items()}
+        }
+
+    path = f"/v1/databases/{database_id}/query"
+    if properties:
+        # filter_properties 让 Notion 只返回需要的属性
+        path += "?" + urlencode([("filter_properties", known[name]["id"]) for name in properties])
+
+    limit = max(1, min(limit, QUERY_ROW_CAP))
+    rows = []
+    cursor = None
+    has_more = True
+    while has_more and len(rows) < limit:
+        body = {"page_size": min(100, limit - len(rows))}
+        if filter:
+            body["filter"] = filter
+        if sorts:
+            body["sorts"] = sorts
+        if cursor:
+            body["start_cursor"] = cursor
+        data = _notion_request("POST", path, body)
+        if data.get("object") == "error":
+            return data
+        for item in data.get("results", []):
+            rows.append({
+                "id": item["id"],
+                "last_edited_time": item.get("last_edited_time"),
+                "properties": {
+                    name: _property_value(prop)
+                    for name, prop in item.get("properties", {}).items()
+                    if not properties or name in properties
+                }
+            })
+        has_more = data.get("has_more", False)
+        cursor = data.get("next_cursor")
+
+    return {
+        "results": rows[:limit],
+        "count": len(rows[:limit]),
+        "truncated": has_more
+    }
+
+
+# 从页面属性中取标题（标题属性名不固定，按类型查找）
+def _page_title(page: dict):
+    for prop in page.get("properties", {}).values():
+        if prop.get("type") == "title":
+            return "".join(t.get("plain_text", "") for t in prop.get("title", []))
+    return ""
+
+
+# Notion 同时接受带连字符和不带连字符的 ID，缓存统一用去掉连字符的小写形式作键
+def _normalize_id(page_id: str):
+    return page_id.replace("-", "").lower()
+
+
+def _load_summary_cache():
+    if not os.path.exists(SUMMARY_CACHE_PATH):
+        return {}
+    with open(SUMMARY_CACHE_PATH, 'r', encoding='utf-8') as f:
+        return {_normalize_id(k): v for k, v in json.load(f).items()}
+
+
+def _save_summary_cache(cache: dict):
+    # 先写临时文件再替换，避免中途崩溃留下损坏的缓存
+    tmp_path = SUMMARY_CACHE_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, SUMMARY_CACHE_PATH)
+
+
+# 页面摘要：未修改的页面直接复用本地缓存，只有编辑过的页面才重新拉取正文并调用 summarizer
+def summarize_pages_cached(page_ids: list, summarizer, max_workers: int = 4):
+    """
+    获取页面摘要
+
+    Args:
+        page_ids: 页面 ID 列表
+        summarizer: summarizer(title, text) -> str，用于生成新摘要
+        max_workers: 同时拉取正文并生成摘要的页面数
+
+    Returns:
+        每个页面的 id、标题、最后编辑时间、摘要，以及是否命中缓存
+    """
+    with _summary_lock:
+        cache = _load_summary_cache()
+
+    results = {}
+    stale = []
+    for page_id in page_ids:
+        page = get_page_properties(page_id)
+        if page.get("object") == "error":
+            results[page_id] = {"id": page_id, "error": page.get("message", "")}
+            continue
+        entry = cache.get(_normalize_id(page_id))
+        if entry is not None and entry.get("last_edited_time") == page.get("last_edited_time"):
+            results[page_id] = {"id": page_id, **entry, "cached": True}
+        else:
+            stale.append((page_id, page))
+
+    def summarize(page_id: str, page: dict):
+        title = _page_title(page)
+        return {
+            "title": title,
+            "last_edited_time": page.get("last_edited_time"),
+            "summary": summarizer(title, get_page_text(page_id))
+        }
+
+    # 编辑过的页面并发生成摘要，LLM 的实际并发仍受全局上限约束
+    updated = {}
+    if stale:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {page_id: executor.submit(summarize, page_id, page) for page_id, page in stale}
+        for page_id, future in futures.items():
+            try:
+                entry = future.result()
+                updated[_normalize_id(page_id)] = entry
+                results[page_id] = {"id": page_id, **entry, "cached": False}
+            except Exception as e:
+                results[page_id] = {"id": page_id, "error": str(e)}
+
+    if updated:
+        # 重新读取后合并，避免覆盖并发写入的其他摘要
+        with _summary_lock:
+            cache = _load_summary_cache()
+            cache.update(updated)
+            _save_summary_cache(cache)
+    return [results[page_id] for page_id in page_ids]
+
+
 # ==================== Rich Text 构建工具 ====================
-# 全局变量：临时存储正在构建的 rich_text 列表
-_rich_text_buffer = []
+# 线程局部变量：临时存储正在构建的 rich_text 列表，批量模式下每个线程各自独立
+_local = threading.local()
+
+
+def _buffer() -> list:
+    if not hasattr(_local, "rich_text_buffer"):
+        _local.rich_text_buffer = []
+    return _local.rich_text_buffer
 
 
 def clear_rich_text():
     """清空 rich_text 缓冲区（内部使用，不暴露给 LLM）"""
-    global _rich_text_buffer
-    _rich_text_buffer = []
+    _local.rich_text_buffer = []
 
 
 def append_text(text: str, bold: bool = False):
@@ -235,7 +539,7 @@ def append_text(text: str, bold: bool = False):
     Returns:
         操作状态信息
     """
-    global _rich_text_buffer
+    _rich_text_buffer = _buffer()
     element = {
         "type": "text",
         "text": {
@@ -263,7 +567,7 @@ def append_page_mention(page_id: str):
     Returns:
         操作状态信息
     """
-    global _rich_text_buffer
+    _rich_text_buffer = _buffer()
     element = {
         "type": "mention",
         "mention": {
@@ -288,8 +592,7 @@ def finish_rich_text():
     Returns:
         完整的 rich_text 列表
     """
-    global _rich_text_buffer
-    result = _rich_text_buffer.copy()
+    result = _buffer().copy()
     return {
         "status": "finished",
         "message": f"Rich text construction finished with {len(result)} elements",
@@ -300,7 +603,7 @@ def finish_rich_text():
 
 def get_rich_text_buffer():
     """获取当前缓冲区内容（用于调试）"""
-    global _rich_text_buffer
+    _rich_text_buffer = _buffer()
     return {
         "count": len(_rich_text_buffer),
         "buffer": _rich_text_buffer